@@ -1,5 +1,6 @@
 # agent_with_auth.py
 import psutil
+import numpy as np
 import platform
 import uuid
 import getpass
@@ -8,19 +9,45 @@ import json
 import csv
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import hashlib
 import hmac
+import functools
 from datetime import datetime, timezone, time as dtime
-import subprocess
 from pynput import mouse, keyboard
 import threading
 import socket
+import signal
+
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
 
 # ---------- 配置設定 ----------
 API_BASE_URL = "http://localhost:8000"  # 您的 ingestion-api 地址
 AUTH_SECRET_KEY = "NTCUST-ENERGY-MONITOR"  # 🆕 更新與 API 相同的密鑰
 FALLBACK_TO_CSV = True  # 如果 API 不可用，是否儲存到 CSV
 
+INGEST_URL = f"{API_BASE_URL}/ingest"
+HEALTH_URL = f"{API_BASE_URL}/health"
+DEVICES_URL = f"{API_BASE_URL}/admin/devices"
+
+# ---------- HTTP 連線池 ----------
+# 共用同一個 Session，保持 keep-alive 連線並對暫時性錯誤自動重試
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=4,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[502, 503, 504],
+        raise_on_status=False  # 重試用盡後仍回傳 response，交由下方狀態碼判斷
+    )
+))
+
 # ---------- 上課節次時間設定 ----------
 class_periods = [
     ("08:10", "09:00"), ("09:10", "10:00"),
@@ -29,54 +56,44 @@ class_periods = [
     ("15:20", "16:10"), ("16:15", "17:05")
 ]
 
+# 啟動時解析一次，轉成「當日秒數」方便直接比較整數
+CLASS_PERIODS = tuple(
+    (dtime.fromisoformat(start_str), dtime.fromisoformat(end_str))
+    for start_str, end_str in class_periods
+)
+CLASS_SECONDS = tuple(
+    (start.hour * 3600 + start.minute * 60, end.hour * 3600 + end.minute * 60)
+    for start, end in CLASS_PERIODS
+)
+
 def is_class_time():
-    now = datetime.now().time()
-    for start_str, end_str in class_periods:
-        start = dtime.fromisoformat(start_str)
-        end = dtime.fromisoformat(end_str)
-        if start <= now <= end:
-            return True
-    return False
+    now = datetime.now()
+    now_sec = now.hour * 3600 + now.minute * 60 + now.second
+    return any(start <= now_sec <= end for start, end in CLASS_SECONDS)
 
 # ---------- MAC 地址和認證功能 ----------
+@functools.lru_cache(maxsize=1)
 def get_mac_address():
-    """取得設備 MAC 地址"""
-    try:
-        # 方法 1: 使用 uuid.getnode()
-        mac = uuid.getnode()
-        mac_str = ':'.join(['{:02x}'.format((mac >> elements) & 0xff) 
-                           for elements in range(0,2*6,2)][::-1])
-        return mac_str.upper()
-    except:
+    """取得設備 MAC 地址（只偵測一次）"""
+    node = uuid.getnode()
+
+    # uuid.getnode() 找不到網卡時會回傳設有 multicast 位元的隨機值，此時才改查網路介面
+    if (node >> 40) & 0x01:
         try:
-            # 方法 2: 使用網路介面
             import netifaces
-            interfaces = netifaces.interfaces()
-            for interface in interfaces:
+            for interface in netifaces.interfaces():
                 if interface != 'lo':  # 排除本地回環
                     addrs = netifaces.ifaddresses(interface)
                     if netifaces.AF_LINK in addrs:
-                        mac = addrs[netifaces.AF_LINK][0]['addr']
-                        return mac.upper().replace('-', ':')
-        except:
+                        mac = addrs[netifaces.AF_LINK][0].get('addr')
+                        if mac:
+                            return mac.upper().replace('-', ':')
+        except (ImportError, OSError, ValueError):
             pass
-        
-        # 方法 3: 系統指令 (備用)
-        try:
-            if platform.system() == "Windows":
-                result = subprocess.run(['getmac'], capture_output=True, text=True)
-                lines = result.stdout.split('\n')
-                for line in lines:
-                    if '-' in line and len(line.split('-')) == 6:
-                        return line.replace('-', ':').upper().strip()
-            else:  # Linux/macOS
-                result = subprocess.run(['ifconfig'], capture_output=True, text=True)
-                # 簡化版解析，實際可能需要更複雜的正則表達式
-                pass
-        except:
-            pass
-    
-    return "00:00:00:00:00:00"  # 預設值
+
+    mac_str = ':'.join(['{:02x}'.format((node >> elements) & 0xff) 
+                       for elements in range(0,2*6,2)][::-1])
+    return mac_str.upper()
 
 def generate_device_certificate(mac_address, secret_key):
     """生成設備憑證"""
@@ -86,88 +103,147 @@ def generate_device_certificate(mac_address, secret_key):
         hashlib.sha256
     ).hexdigest()
 
+_AUTH_HEADERS = None
+
 def get_auth_headers():
-    """取得認證 Headers"""
-    mac_address = get_mac_address()
-    certificate = generate_device_certificate(mac_address, AUTH_SECRET_KEY)
-    
+    """取得認證 Headers（MAC 與密鑰在執行期間不變，只計算一次）"""
+    global _AUTH_HEADERS
+    if _AUTH_HEADERS is None:
+        mac_address = get_mac_address()
+        certificate = generate_device_certificate(mac_address, AUTH_SECRET_KEY)
+        _AUTH_HEADERS = {
+            "Content-Type": "application/json",
+            "MAC-Address": mac_address,
+            "Device-Certificate": certificate
+        }
+    return _AUTH_HEADERS
+
+# ---------- 🆕 增強硬體資訊收集（用於指紋生成）----------
+@functools.lru_cache(maxsize=1)
+def _collect_system_info():
+    """收集硬體資訊；只快取成功的結果，失敗時拋出例外以便下次重試"""
     return {
-        "Content-Type": "application/json",
-        "MAC-Address": mac_address,
-        "Device-Certificate": certificate
+        "cpu_model": platform.processor() or "Unknown",
+        "cpu_count": psutil.cpu_count(),
+        "total_memory": psutil.virtual_memory().total,
+        "disk_partitions": len(psutil.disk_partitions()),
+        "network_interfaces": len(psutil.net_if_addrs()),
+        "platform_machine": platform.machine(),
+        "platform_architecture": platform.architecture()[0]
     }
 
-# ---------- 🆕 增強硬體資訊收集（用於指紋生成）----------
 def get_enhanced_system_info():
-    """收集更詳細的系統資訊用於設備指紋"""
+    """收集更詳細的系統資訊用於設備指紋（硬體資訊不會變動，成功後只收集一次）"""
     try:
-        system_info = {
-            "cpu_model": platform.processor() or "Unknown",
-            "cpu_count": psutil.cpu_count(),
-            "total_memory": psutil.virtual_memory().total,
-            "disk_partitions": len(psutil.disk_partitions()),
-            "network_interfaces": len(psutil.net_if_addrs()),
-            "platform_machine": platform.machine(),
-            "platform_architecture": platform.architecture()[0]
-        }
-        return system_info
-    except:
+        return _collect_system_info()
+    except Exception:
         return {}
 
-# ---------- 硬體數據擷取 (保持原有邏輯) ----------
+# ---------- 硬體數據擷取 ----------
+# GPU 透過 NVML 直接查詢，避免每次 fork nvidia-smi
+_NVML_HANDLE = None
+_NVML_AVAILABLE = None  # None: 尚未初始化；False: 無可用 GPU，不再重試
+
+def get_nvml_handle():
+    """初始化 NVML 並取得第一張 GPU 的 handle（只初始化一次）"""
+    global _NVML_HANDLE, _NVML_AVAILABLE
+    if _NVML_AVAILABLE is None:
+        if pynvml is None:
+            _NVML_AVAILABLE = False
+        else:
+            try:
+                pynvml.nvmlInit()
+                _NVML_HANDLE = pynvml.nvmlDeviceGetHandleByIndex(0)
+                _NVML_AVAILABLE = True
+            except pynvml.NVMLError:
+                _NVML_AVAILABLE = False
+    return _NVML_HANDLE
+
+@functools.lru_cache(maxsize=1)
 def get_gpu_model():
+    handle = get_nvml_handle()
+    if handle is None:
+        return "Unknown"
     try:
-        result = subprocess.run(
-            ['nvidia-smi', '--query-gpu=gpu_name', '--format=csv,noheader'],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
-        if result.stderr:
-            return "Unknown"
-        return result.stdout.decode('utf-8').strip()
-    except:
+        name = pynvml.nvmlDeviceGetName(handle)
+        return name.decode("utf-8") if isinstance(name, bytes) else name
+    except pynvml.NVMLError:
         return "Unknown"
 
 def get_gpu_usage():
+    handle = get_nvml_handle()
+    if handle is None:
+        return 0
     try:
-        result = subprocess.run(
-            ['nvidia-smi', '--query-gpu=utilization.gpu', '--format=csv,noheader,nounits'],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
-        if result.stderr:
-            return 0
-        usage = result.stdout.decode('utf-8').strip()
-        return float(usage) if usage else 0
-    except:
+        return float(pynvml.nvmlDeviceGetUtilizationRates(handle).gpu)
+    except pynvml.NVMLError:
         return 0
 
 def get_gpu_power_watt():
+    handle = get_nvml_handle()
+    if handle is None:
+        return 0
     try:
-        result = subprocess.run(
-            ['nvidia-smi', '--query-gpu=power.draw', '--format=csv,noheader,nounits'],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
-        if result.stderr:
-            return 0
-        power = result.stdout.decode('utf-8').strip()
-        return float(power) if power else 0
-    except:
+        return pynvml.nvmlDeviceGetPowerUsage(handle) / 1000.0  # mW -> W
+    except pynvml.NVMLError:
         return 0
 
-def get_cpu_power():
-    return round(psutil.cpu_percent(interval=1) * 0.5, 2)
-
 def get_memory_usage():
     memory = psutil.virtual_memory()
     return memory.used / (1024 * 1024)
 
-def get_disk_read_write_rate(interval=1):
+def collect_metrics(interval=1):
+    """一次取樣所有效能指標（CPU 與磁碟共用同一段取樣時間）"""
+    psutil.cpu_percent(interval=None)  # 重設 CPU 取樣起點
     before = psutil.disk_io_counters()
     time.sleep(interval)
+    cpu_percent = psutil.cpu_percent(interval=None)
     after = psutil.disk_io_counters()
 
     read_rate = (after.read_bytes - before.read_bytes) / (1024 * 1024) / interval
     write_rate = (after.write_bytes - before.write_bytes) / (1024 * 1024) / interval
-    return round(read_rate, 2), round(write_rate, 2)
+    return {
+        "cpu": round(cpu_percent * 0.5, 2),
+        "gpu": get_gpu_power_watt(),
+        "memory": get_memory_usage(),
+        "disk_read": round(read_rate, 2),
+        "disk_write": round(write_rate, 2),
+    }
+
+# ---------- 背景指標取樣 ----------
+SAMPLE_INTERVAL = 10  # 秒
+
+class MetricSampler(threading.Thread):
+    """背景定期取樣指標，主迴圈透過 snapshot() 非阻塞讀取最新結果"""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._latest = None
+        self._ready = threading.Event()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                metrics = collect_metrics(interval=1)
+                with self._lock:
+                    self._latest = metrics
+                self._ready.set()
+            except Exception as e:
+                print(f"⚠️ 指標取樣失敗: {e}")
+            self._stop_event.wait(self.interval)
+
+    def wait_ready(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._latest) if self._latest else None
+
+    def stop(self):
+        self._stop_event.set()
 
 def get_system_power(cpu, gpu, memory):
     return cpu + gpu + (memory * 0.1)
@@ -186,32 +262,35 @@ def get_device_info():
     )
 
 # ---------- 資料傳送 (新增 API 功能) ----------
+# (API 欄位, agent 欄位) 對照表，欄位異動時只需修改這裡
+_API_KEY_MAP = (
+    ("timestamp_utc", "timestamp"),
+    ("gpu_model", "gpu_model"),
+    ("gpu_usage_percent", "gpu_usage"),
+    ("gpu_power_watt", "gpu"),
+    ("cpu_power_watt", "cpu"),
+    ("memory_used_mb", "memory"),
+    ("disk_read_mb_s", "disk_read"),
+    ("disk_write_mb_s", "disk_write"),
+    ("system_power_watt", "system_power"),
+    ("device_id", "device_id"),
+    ("user_id", "user_id"),
+    ("agent_version", "agent_version"),
+    ("os_type", "os_type"),
+    ("os_version", "os_version"),
+    ("location", "location"),
+)
+
 def send_to_api(data):
     """發送資料到 ingestion-api"""
     try:
         headers = get_auth_headers()
         
         # 轉換資料格式以符合 API schema
-        api_data = {
-            "timestamp_utc": data["timestamp"],
-            "gpu_model": data["gpu_model"],
-            "gpu_usage_percent": data["gpu_usage"],
-            "gpu_power_watt": data["gpu"],
-            "cpu_power_watt": data["cpu"],
-            "memory_used_mb": data["memory"],
-            "disk_read_mb_s": data["disk_read"],
-            "disk_write_mb_s": data["disk_write"],
-            "system_power_watt": data["system_power"],
-            "device_id": data["device_id"],
-            "user_id": data["user_id"],
-            "agent_version": data["agent_version"],
-            "os_type": data["os_type"],
-            "os_version": data["os_version"],
-            "location": data["location"]
-        }
+        api_data = {api_key: data[agent_key] for api_key, agent_key in _API_KEY_MAP}
         
-        response = requests.post(
-            f"{API_BASE_URL}/ingest",
+        response = SESSION.post(
+            INGEST_URL,
             json=api_data,
             headers=headers,
             timeout=10
@@ -259,40 +338,66 @@ def send_to_api(data):
         print(f"❌ 發送資料失敗: {str(e)}")
         return False
 
-# ---------- CSV 備援儲存 (保持原有邏輯) ----------
-data_buffer = []
-file_count = 0
+# ---------- CSV 備援儲存 ----------
+# 每筆資料立即寫入（append），每 50 筆換一個檔案
+CSV_ROWS_PER_FILE = 50
 output_dir = "agent_logs"
 os.makedirs(output_dir, exist_ok=True)
 
-def save_to_csv(row):
-    global data_buffer, file_count
-    data_buffer.append(row)
-    if len(data_buffer) >= 50:
-        filename = os.path.join(output_dir, f"agent_data_{file_count}.csv")
-        with open(filename, mode="w", newline="", encoding="utf-8") as f:
-            writer = csv.DictWriter(f, fieldnames=row.keys())
-            writer.writeheader()
-            writer.writerows(data_buffer)
-        print(f"💾 CSV 備份已儲存：{filename}")
-        data_buffer = []
+csv_file = None
+csv_writer = None
+csv_fieldnames = None  # 第一筆資料決定欄位，之後的檔案沿用
+csv_row_count = 0
+file_count = 0
+
+def open_csv_file(fieldnames):
+    """開啟下一個尚未存在的 CSV 備份檔"""
+    global csv_file, csv_writer, csv_row_count, file_count
+    while os.path.exists(os.path.join(output_dir, f"agent_data_{file_count}.csv")):
         file_count += 1
+    filename = os.path.join(output_dir, f"agent_data_{file_count}.csv")
+    csv_file = open(filename, mode="a", newline="", encoding="utf-8")
+    csv_writer = csv.DictWriter(csv_file, fieldnames=fieldnames, extrasaction="ignore")
+    csv_writer.writeheader()
+    csv_row_count = 0
+
+def close_csv_file():
+    """關閉目前的 CSV 備份檔；下一筆資料寫入時才開新檔"""
+    global csv_file, csv_writer
+    if csv_file is not None:
+        csv_file.close()
+    csv_file = None
+    csv_writer = None
+
+def save_to_csv(row):
+    global csv_fieldnames, csv_row_count
+    if csv_writer is None:
+        if csv_fieldnames is None:
+            csv_fieldnames = list(row.keys())
+        open_csv_file(csv_fieldnames)
+    csv_writer.writerow(row)
+    csv_file.flush()
+    csv_row_count += 1
+    if csv_row_count >= CSV_ROWS_PER_FILE:
+        print(f"💾 CSV 備份已儲存：{csv_file.name}")
+        close_csv_file()
 
 # ---------- 資料處理和儲存 ----------
-def process_and_send_data():
-    """處理和發送資料"""
+def process_and_send_data(metrics):
+    """處理和發送資料（沿用主迴圈已取樣的 metrics，不再重新量測）"""
     device_id, user_id, agent_version, os_type, os_version, location = get_device_info()
     timestamp = get_timestamp()
 
     gpu_model = get_gpu_model()
     gpu_usage = get_gpu_usage()
-    gpu_power = get_gpu_power_watt()
-    cpu_power = get_cpu_power()
-    memory_used = get_memory_usage()
-    disk_read, disk_write = get_disk_read_write_rate(interval=1)
+    cpu_power = metrics["cpu"]
+    gpu_power = metrics["gpu"]
+    memory_used = metrics["memory"]
+    disk_read = metrics["disk_read"]
+    disk_write = metrics["disk_write"]
     system_power = get_system_power(cpu_power, gpu_power, memory_used)
 
-    # 🆕 收集增強的系統資訊（指紋相關）
+    # 🆕 增強的系統資訊（指紋相關，啟動時已快取）
     enhanced_info = get_enhanced_system_info()
 
     data = {
@@ -329,13 +434,19 @@ def process_and_send_data():
     
     return api_success
 
-# ---------- 差異判斷 (保持原有邏輯) ----------
-previous_data = {"cpu": 0, "gpu": 0, "memory": 0, "disk_read": 0, "disk_write": 0}
+# ---------- 差異判斷 ----------
+# 指標以固定順序存成 float32 陣列，一次向量化比較
+METRIC_KEYS = ("cpu", "gpu", "memory", "disk_read", "disk_write")
+previous_data = np.zeros(len(METRIC_KEYS), dtype=np.float32)
 CHANGE_THRESHOLD = 5
 
+def metrics_to_array(metrics):
+    return np.array([metrics[k] for k in METRIC_KEYS], dtype=np.float32)
+
 def has_significant_change(new, old):
-    changes = [k for k in new if abs(new[k] - old[k]) > CHANGE_THRESHOLD]
-    if changes:
+    changed = np.abs(new - old) > CHANGE_THRESHOLD
+    if changed.any():
+        changes = [k for k, c in zip(METRIC_KEYS, changed) if c]
         print(f"📊 資料變動超過閾值：{', '.join(changes)}")
         return True
     return False
@@ -362,7 +473,7 @@ def check_api_connection():
     """檢查 API 連接並驗證設備註冊狀態"""
     try:
         # 檢查 API 健康狀態
-        response = requests.get(f"{API_BASE_URL}/health", timeout=5)
+        response = SESSION.get(HEALTH_URL, timeout=5)
         if response.status_code == 200:
             print("✅ API 服務運行正常")
         else:
@@ -380,7 +491,7 @@ def check_api_connection():
     
     try:
         headers = get_auth_headers()
-        response = requests.get(f"{API_BASE_URL}/admin/devices/{mac_address}", headers=headers, timeout=5)
+        response = SESSION.get(f"{DEVICES_URL}/{mac_address}", headers=headers, timeout=5)
         
         if response.status_code == 200:
             device_info = response.json()
@@ -397,6 +508,13 @@ def check_api_connection():
         return False
 
 # ---------- 主迴圈 ----------
+SEND_INTERVAL = 60  # 秒
+STOP_POLL_INTERVAL = 1.0  # 秒，等待期間檢查停止訊號的間隔
+STOP = threading.Event()
+
+def request_stop(signum, frame):
+    STOP.set()
+
 def main():
     global user_active, previous_data 
     
@@ -412,9 +530,19 @@ def main():
         print("❌ API 不可用且未啟用 CSV 備援，程式結束")
         return
     
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    get_enhanced_system_info()  # 啟動時先收集並快取硬體資訊
+
+    sampler = MetricSampler()
+    sampler.start()
+    sampler.wait_ready(timeout=5)
     print("⏰ 開始監控...")
     
-    while True:
+    # 以固定時間點喚醒，避免取樣與傳送耗時累積成漂移
+    next_tick = time.monotonic()
+    while not STOP.is_set():
         try:
             in_class = is_class_time()
             should_grab = False
@@ -428,31 +556,30 @@ def main():
                 user_active = False
 
             if should_grab:
-                cpu_power = get_cpu_power()
-                gpu_power = get_gpu_power_watt()
-                memory_used = get_memory_usage()
-                disk_read, disk_write = get_disk_read_write_rate(interval=1)
-
-                new_data = {
-                    "cpu": cpu_power,
-                    "gpu": gpu_power,
-                    "memory": memory_used,
-                    "disk_read": disk_read,
-                    "disk_write": disk_write,
-                }
-
-                if has_significant_change(new_data, previous_data):
-                    success = process_and_send_data()
-                    previous_data = new_data
-
-            time.sleep(60)
+                new_data = sampler.snapshot()
+
+                if new_data is None:
+                    print("⏳ 尚無取樣資料，等待下一輪")
+                else:
+                    new_values = metrics_to_array(new_data)
+                    if has_significant_change(new_values, previous_data):
+                        success = process_and_send_data(new_data)
+                        previous_data = new_values
             
-        except KeyboardInterrupt:
-            print("\n👋 Agent 停止運行")
-            break
         except Exception as e:
             print(f"❌ 運行時錯誤: {e}")
-            time.sleep(60)  # 等待後重試
+
+        # 若本輪耗時超過一個週期，從現在重新對齊而不是連續補跑
+        next_tick = max(next_tick + SEND_INTERVAL, time.monotonic())
+        # Windows 上帶 timeout 的 Event.wait 無法被 Ctrl+C 中斷，分段等待讓 SIGINT 能及時處理
+        remaining = next_tick - time.monotonic()
+        while remaining > 0 and not STOP.is_set():
+            STOP.wait(min(remaining, STOP_POLL_INTERVAL))
+            remaining = next_tick - time.monotonic()
+
+    sampler.stop()
+    close_csv_file()
+    print("\n👋 Agent 停止運行")
 
 # ---------- 啟動 ----------
 if __name__ == "__main__":
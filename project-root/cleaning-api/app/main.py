@@ -6,5 +6,5 @@ app = FastAPI()
 
 @app.post("/clean")
 def clean_endpoint(data: RawEnergyData):
-    cleaned = clean_energy_data(data.dict())
+    cleaned = clean_energy_data(data.model_dump())
     return {"cleaned_data": cleaned}
\ No newline at end of file
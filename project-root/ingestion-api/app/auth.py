@@ -1,11 +1,15 @@
 # app/auth.py
 from fastapi import HTTPException, Header, Depends, Request
 from sqlalchemy.orm import Session
+from sqlalchemy import update, case
 import hashlib
 import hmac
 import os
+import threading
+import time
 import json  # 🆕 新增匯入
 import logging
+from functools import lru_cache
 from .database import SessionLocal
 from .models import AuthorizedDevice
 from . import models  # 🆕 新增匯入
@@ -17,6 +21,91 @@ logger = logging.getLogger(__name__)
 COMPATIBILITY_MODE = os.getenv("COMPATIBILITY_MODE", "true").lower() == "true"
 DEFAULT_ALLOWED_IPS = os.getenv("DEFAULT_ALLOWED_IPS", "").split(",") if os.getenv("DEFAULT_ALLOWED_IPS") else []
 
+@lru_cache(maxsize=1024)
+def _normalized_mac(mac_address: str) -> str:
+    """標準化並快取 MAC 地址（大寫、以冒號分隔）"""
+    mac_address = mac_address.upper()
+    if '-' in mac_address:
+        mac_address = mac_address.replace('-', ':')
+    return mac_address
+
+@lru_cache(maxsize=8)
+def _hmac_template(secret_key: str):
+    """建立已載入密鑰的 HMAC 物件（ipad/opad 只計算一次）"""
+    return hmac.new(secret_key.encode(), digestmod=hashlib.sha256)
+
+@lru_cache(maxsize=1024)
+def _expected_cert(secret_key: str, mac_address: str) -> str:
+    """計算並快取指定 MAC 的預期憑證"""
+    h = _hmac_template(secret_key).copy()
+    h.update(mac_address.encode())
+    return h.hexdigest()
+
+# ---------- 白名單查詢快取與 last_seen 批次更新 ----------
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "60"))
+AUTH_CACHE_MAXSIZE = 1024
+LAST_SEEN_FLUSH_INTERVAL = float(os.getenv("LAST_SEEN_FLUSH_INTERVAL", "30"))
+
+_state_lock = threading.Lock()
+_AUTH_CACHE: dict[str, tuple[bool, float]] = {}  # mac -> (是否授權, 到期時間)
+_LAST_SEEN: dict[str, datetime] = {}             # mac -> 尚未寫回的 last_seen
+_flush_stop = threading.Event()
+
+def _cache_authorization(mac_address: str, authorized: bool, now: float):
+    with _state_lock:
+        if len(_AUTH_CACHE) >= AUTH_CACHE_MAXSIZE:
+            for key in [k for k, (_, expires) in _AUTH_CACHE.items() if expires <= now]:
+                del _AUTH_CACHE[key]
+            if len(_AUTH_CACHE) >= AUTH_CACHE_MAXSIZE:
+                del _AUTH_CACHE[next(iter(_AUTH_CACHE))]
+        _AUTH_CACHE[mac_address] = (authorized, now + AUTH_CACHE_TTL)
+
+def invalidate_device_cache(mac_address: str):
+    """白名單異動後清除該設備的授權快取"""
+    with _state_lock:
+        _AUTH_CACHE.pop(_normalized_mac(mac_address), None)
+
+def flush_last_seen() -> int:
+    """將累積的 last_seen 以單一 UPDATE 寫回資料庫，回傳更新的設備數"""
+    with _state_lock:
+        if not _LAST_SEEN:
+            return 0
+        pending = dict(_LAST_SEEN)
+        _LAST_SEEN.clear()
+    
+    db = SessionLocal()
+    try:
+        db.execute(
+            update(AuthorizedDevice)
+            .where(AuthorizedDevice.mac_address.in_(list(pending)))
+            .values(last_seen=case(pending, value=AuthorizedDevice.mac_address))
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+        return len(pending)
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Failed to flush last_seen: {str(e)}")
+        # 寫回失敗時放回佇列，但不覆蓋期間更新的時間
+        with _state_lock:
+            for mac_address, seen in pending.items():
+                _LAST_SEEN.setdefault(mac_address, seen)
+        return 0
+    finally:
+        db.close()
+
+def _last_seen_flush_loop():
+    while not _flush_stop.wait(LAST_SEEN_FLUSH_INTERVAL):
+        flush_last_seen()
+
+def start_last_seen_flusher():
+    _flush_stop.clear()
+    threading.Thread(target=_last_seen_flush_loop, name="last-seen-flusher", daemon=True).start()
+
+def stop_last_seen_flusher():
+    _flush_stop.set()
+    flush_last_seen()
+
 def get_db():
     db = SessionLocal()
     try:
@@ -144,15 +233,25 @@ class DeviceAuthenticator:
             return False
             
         mac_address = self._normalize_mac(mac_address)
+        now = time.monotonic()
         
-        device = self.db.query(AuthorizedDevice).filter(
-            AuthorizedDevice.mac_address == mac_address,
-            AuthorizedDevice.is_active == True
-        ).first()
+        with _state_lock:
+            cached = _AUTH_CACHE.get(mac_address)
+        
+        if cached and cached[1] > now:
+            authorized = cached[0]
+        else:
+            device = self.db.query(AuthorizedDevice).filter(
+                AuthorizedDevice.mac_address == mac_address,
+                AuthorizedDevice.is_active == True
+            ).first()
+            authorized = device is not None
+            _cache_authorization(mac_address, authorized, now)
         
-        if device:
-            device.last_seen = datetime.now()
-            self.db.commit()
+        if authorized:
+            # last_seen 先暫存，由背景執行緒定期批次寫回
+            with _state_lock:
+                _LAST_SEEN[mac_address] = datetime.now()
             logger.info(f"Authorized device accessed: {mac_address}")
             return True
         
@@ -165,20 +264,17 @@ class DeviceAuthenticator:
             return False
         
         mac_address = self._normalize_mac(mac_address)
-        expected_cert = hmac.new(
-            self.secret_key.encode(), 
-            mac_address.encode(), 
-            hashlib.sha256
-        ).hexdigest()
+        expected_cert = _expected_cert(self.secret_key, mac_address)
         
-        return certificate == expected_cert
+        # 以 bytes 比較：常數時間，且 header 含非 ASCII 字元時不會拋出 TypeError
+        return hmac.compare_digest(certificate.encode(), expected_cert.encode())
     
     def _normalize_mac(self, mac_address: str) -> str:
         """標準化 MAC 地址格式"""
-        return mac_address.upper().replace('-', ':')
+        return _normalized_mac(mac_address)
 
-# 兼容性認證依賴
-async def verify_device_auth_compatible(
+# 兼容性認證依賴（同步函式，由 FastAPI 放到 threadpool 執行，不阻塞事件迴圈）
+def verify_device_auth_compatible(
     request: Request,
     mac_address: str = Header(None, alias="MAC-Address"),
     device_certificate: str = Header(None, alias="Device-Certificate"),
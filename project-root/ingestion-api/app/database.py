@@ -4,6 +4,14 @@ from sqlalchemy.orm import sessionmaker
 
 DATABASE_URL = "postgresql://user:password@db:5432/energy"
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
+# 加大編譯快取，讓 INSERT/SELECT 的編譯結果可跨請求重用
+engine = create_engine(
+    DATABASE_URL,
+    query_cache_size=1200,
+    pool_pre_ping=True,
+    pool_size=10,
+    max_overflow=20
+)
+# 寫入後不再回讀 ORM 物件，commit 後不需要讓屬性過期
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+Base = declarative_base()
\ No newline at end of file
@@ -0,0 +1,29 @@
+# app/init_db.py
+# 一次性建立資料表，於容器啟動時執行：python -m app.init_db
+import logging
+import time
+from sqlalchemy.exc import OperationalError
+from .database import Base, engine
+from .migrations import upgrade_schema
+from . import models  # noqa: F401 確保所有資料表都已註冊到 Base.metadata
+
+logger = logging.getLogger(__name__)
+
+def init_db(retries: int = 5, delay: float = 2.0):
+    """建立所有資料表並套用結構調整（資料庫尚未就緒時稍後重試）"""
+    for attempt in range(1, retries + 1):
+        try:
+            logger.info("開始建立資料表...")
+            Base.metadata.create_all(bind=engine)
+            upgrade_schema(engine)
+            logger.info("資料表建立完成")
+            return
+        except OperationalError as e:
+            if attempt == retries:
+                raise
+            logger.warning(f"資料庫尚未就緒 ({attempt}/{retries}): {e}")
+            time.sleep(delay)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    init_db()
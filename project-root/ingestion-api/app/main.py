@@ -1,25 +1,67 @@
 from fastapi import FastAPI, Depends, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
 from sqlalchemy.orm import Session
 from . import models, schemas
-from .database import SessionLocal, engine, Base
-from .auth import verify_device_auth_compatible, get_db, DeviceAuthenticator
+from .database import SessionLocal
+from .auth import (
+    verify_device_auth_compatible, get_db, DeviceAuthenticator,
+    invalidate_device_cache, start_last_seen_flusher, stop_last_seen_flusher
+)
 from .utils.mac_manager import MACManager
-import requests
+from .routing import ORJSONRoute
+from .init_db import init_db
+import httpx
 import logging
-from datetime import datetime
+import os
+from datetime import datetime, time, timedelta, timezone
 from typing import List
-from sqlalchemy import text, func, distinct
+from sqlalchemy import text, func, distinct, insert
 
-app = FastAPI(title="Energy Data Ingestion API", version="1.2.0")
+app = FastAPI(
+    title="Energy Data Ingestion API",
+    version="1.2.0",
+    default_response_class=ORJSONResponse
+)
+# 所有路由的 request body 改用 orjson 解析（需在註冊路由前設定）
+app.router.route_class = ORJSONRoute
 
 # 設定日誌
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# 建立所有資料表
-logger.info("開始建立資料表...")
-Base.metadata.create_all(bind=engine)
-logger.info("資料表建立完成")
+# 資料表改由容器啟動時的 `python -m app.init_db` 建立；開發環境可設 AUTO_MIGRATE=true
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "false").lower() == "true"
+
+@app.on_event("startup")
+def auto_migrate():
+    if AUTO_MIGRATE:
+        init_db()
+
+# 白名單設備的 last_seen 由背景執行緒批次寫回
+@app.on_event("startup")
+def start_background_jobs():
+    start_last_seen_flusher()
+
+@app.on_event("shutdown")
+def stop_background_jobs():
+    stop_last_seen_flusher()
+
+# 清洗服務連線池（整個程序共用，保持 keep-alive）
+CLEANER = httpx.AsyncClient(
+    base_url="http://cleaner:8100",
+    timeout=10,
+    limits=httpx.Limits(max_keepalive_connections=20)
+)
+
+@app.on_event("shutdown")
+async def close_cleaner_client():
+    await CLEANER.aclose()
+
+def _today_range():
+    """取得今日（UTC）的時間範圍 [start, end)，供 timestamp_utc 範圍查詢使用"""
+    start = datetime.combine(datetime.now(timezone.utc).date(), time.min, tzinfo=timezone.utc)
+    return start, start + timedelta(days=1)
 
 @app.get("/")
 async def root():
@@ -34,11 +76,11 @@ async def health_check(db: Session = Depends(get_db)):
     """健康檢查端點"""
     try:
         # 檢查資料庫連接
-        db.execute(text("SELECT 1"))
+        await run_in_threadpool(db.execute, text("SELECT 1"))
         
         # 檢查清洗服務
         try:
-            response = requests.get("http://cleaner:8100/health", timeout=5)
+            response = await CLEANER.get("/health", timeout=5)
             cleaner_healthy = response.status_code == 200
         except:
             cleaner_healthy = False
@@ -54,7 +96,7 @@ async def health_check(db: Session = Depends(get_db)):
         raise HTTPException(status_code=503, detail="Service unhealthy")
 
 @app.post("/ingest")
-def ingest(
+async def ingest(
     request: Request,
     data: schemas.EnergyData, 
     db: Session = Depends(get_db),
@@ -62,11 +104,14 @@ def ingest(
 ):
     """接收能耗資料並進行處理（使用指紋認證，不強制白名單）"""
     logger.info(f"Received data from device: {auth['mac_address']} (method: {auth['method']})")
+    payload = data.model_dump()
     
     try:
         # 設備指紋檢查（主要認證方式）
         authenticator = DeviceAuthenticator(db)
-        fingerprint_result = authenticator.check_device_fingerprint(data.dict())
+        fingerprint_result = await run_in_threadpool(
+            authenticator.check_device_fingerprint, payload
+        )
         
         # 記錄指紋檢查結果
         risk_level = fingerprint_result["risk_level"]
@@ -81,28 +126,37 @@ def ingest(
             logger.info(f"✅ High risk device allowed due to whitelist: {data.device_id}")
         
         # 寫入 raw 資料（加入指紋資訊）
-        raw_data = data.dict()
+        raw_data = dict(payload)
         raw_data['device_fingerprint'] = fingerprint_result.get('fingerprint', '')
         raw_data['risk_level'] = fingerprint_result['risk_level']
         raw_data['similarity_score'] = fingerprint_result.get('similarity_score', 0.0)
         
-        raw_record = models.EnergyRaw(**raw_data)
-        db.add(raw_record)
+        # 只寫入不回讀，直接用 Core insert 省去 ORM 的 identity map 與 flush
+        await run_in_threadpool(
+            db.execute, insert(models.EnergyRaw).values(**raw_data)
+        )
 
-        # 呼叫 cleaning-api
+        # 呼叫 cleaning-api（await 期間事件迴圈可處理其他請求）
         try:
-            response = requests.post("http://cleaner:8100/clean", json=data.dict(), timeout=10)
+            response = await CLEANER.post(
+                "/clean",
+                content=data.model_dump_json(),
+                headers={"Content-Type": "application/json"}
+            )
             response.raise_for_status()
             cleaned_data = response.json()["cleaned_data"]
+            # 清洗服務回傳的時間為字串，改用已解析的 datetime 寫入
+            cleaned_data['timestamp_utc'] = data.timestamp_utc
             
-            # 清洗後的資料也加入指紋資訊
-            cleaned_data['device_fingerprint'] = fingerprint_result.get('fingerprint', '')
+            # 清洗後的資料也加入指紋資訊（energy_cleaned 沒有 device_fingerprint 欄位）
             cleaned_data['risk_level'] = fingerprint_result['risk_level']
+            cleaned_data['similarity_score'] = fingerprint_result.get('similarity_score', 0.0)
             
-            cleaned_record = models.EnergyCleaned(**cleaned_data)
-            db.add(cleaned_record)
+            await run_in_threadpool(
+                db.execute, insert(models.EnergyCleaned).values(**cleaned_data)
+            )
             
-            db.commit()
+            await run_in_threadpool(db.commit)
             logger.info(f"✅ Successfully processed data from {data.device_id}")
             
             return {
@@ -119,7 +173,7 @@ def ingest(
             
         except Exception as e:
             # 即使清洗失敗，也要儲存原始資料
-            db.commit()
+            await run_in_threadpool(db.commit)
             logger.warning(f"Cleaning failed for {data.device_id}: {str(e)}")
             return {
                 "status": "partial_success", 
@@ -130,7 +184,7 @@ def ingest(
             }
             
     except Exception as e:
-        db.rollback()
+        await run_in_threadpool(db.rollback)
         logger.error(f"Failed to process data from {data.device_id}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Processing failed: {str(e)}")
 
@@ -147,9 +201,10 @@ async def get_dashboard(db: Session = Depends(get_db)):
         unique_devices = db.query(func.count(distinct(models.EnergyRaw.device_id))).scalar()
         
         # 今日統計
-        today = datetime.now().date()
+        today_start, today_end = _today_range()
         today_records = db.query(models.EnergyRaw).filter(
-            models.EnergyRaw.timestamp_utc.like(f"{today}%")
+            models.EnergyRaw.timestamp_utc >= today_start,
+            models.EnergyRaw.timestamp_utc < today_end
         ).count()
         
         # 風險等級統計（安全檢查）
@@ -376,6 +431,7 @@ async def add_device(device_data: schemas.DeviceCreate, db: Session = Depends(ge
     )
     
     if success:
+        invalidate_device_cache(device_data.mac_address)
         return {"status": "success", "message": "Device added to whitelist"}
     else:
         raise HTTPException(status_code=400, detail="Failed to add device or device already exists")
@@ -387,6 +443,7 @@ async def remove_device(mac_address: str, db: Session = Depends(get_db)):
     success = manager.remove_device(mac_address)
     
     if success:
+        invalidate_device_cache(mac_address)
         return {"status": "success", "message": "Device removed from whitelist"}
     else:
         raise HTTPException(status_code=404, detail="Device not found")
@@ -410,14 +467,16 @@ async def get_device_info(mac_address: str, db: Session = Depends(get_db)):
 async def get_metrics(db: Session = Depends(get_db)):
     """取得系統指標"""
     try:
-        today = datetime.now().date()
+        today_start, today_end = _today_range()
         
         raw_count = db.query(models.EnergyRaw).filter(
-            models.EnergyRaw.timestamp_utc.like(f"{today}%")
+            models.EnergyRaw.timestamp_utc >= today_start,
+            models.EnergyRaw.timestamp_utc < today_end
         ).count()
         
         cleaned_count = db.query(models.EnergyCleaned).filter(
-            models.EnergyCleaned.timestamp_utc.like(f"{today}%")
+            models.EnergyCleaned.timestamp_utc >= today_start,
+            models.EnergyCleaned.timestamp_utc < today_end
         ).count()
         
         try:
@@ -430,12 +489,14 @@ async def get_metrics(db: Session = Depends(get_db)):
         # 異常設備統計
         try:
             high_risk_count = db.query(models.EnergyRaw).filter(
-                models.EnergyRaw.timestamp_utc.like(f"{today}%"),
+                models.EnergyRaw.timestamp_utc >= today_start,
+                models.EnergyRaw.timestamp_utc < today_end,
                 models.EnergyRaw.risk_level == "high"
             ).count()
             
             medium_risk_count = db.query(models.EnergyRaw).filter(
-                models.EnergyRaw.timestamp_utc.like(f"{today}%"),
+                models.EnergyRaw.timestamp_utc >= today_start,
+                models.EnergyRaw.timestamp_utc < today_end,
                 models.EnergyRaw.risk_level == "medium"
             ).count()
         except:
@@ -0,0 +1,33 @@
+# app/migrations.py
+# create_all 不會修改已存在的資料表，既有資料庫的結構調整放在這裡（可重複執行）
+import logging
+from sqlalchemy import inspect, text, String, DateTime
+
+logger = logging.getLogger(__name__)
+
+# timestamp_utc 由 String 改為 timestamptz 的資料表
+TIMESTAMP_TABLES = ("energy_raw", "energy_cleaned")
+
+def upgrade_schema(engine):
+    """將既有資料表調整為目前 models 的結構"""
+    inspector = inspect(engine)
+    # ALTER COLUMN ... TYPE 為 PostgreSQL 語法，其他資料庫只建立索引
+    tables = TIMESTAMP_TABLES if engine.dialect.name == "postgresql" else ()
+    with engine.begin() as conn:
+        for table in tables:
+            column_type = {c["name"]: c["type"] for c in inspector.get_columns(table)}.get("timestamp_utc")
+            if isinstance(column_type, String):
+                # 舊資料為帶 Z 的 ISO 字串，轉 timestamptz 時會保留 UTC 時區
+                using = "timestamp_utc::timestamptz"
+            elif isinstance(column_type, DateTime) and not column_type.timezone:
+                using = "timestamp_utc AT TIME ZONE 'UTC'"
+            else:
+                continue
+            logger.info(f"轉換 {table}.timestamp_utc 為 timestamptz...")
+            conn.execute(text(
+                f"ALTER TABLE {table} ALTER COLUMN timestamp_utc TYPE timestamptz USING {using}"
+            ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_energy_raw_device_ts "
+            "ON energy_raw (device_id, timestamp_utc)"
+        ))
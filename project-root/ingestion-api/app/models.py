@@ -1,12 +1,12 @@
 # app/models.py
-from sqlalchemy import Column, Float, String, DateTime, Boolean
+from sqlalchemy import Column, Float, String, DateTime, Boolean, Index
 from sqlalchemy.sql import func
 from .database import Base
 
 class EnergyRaw(Base):
     __tablename__ = "energy_raw"
 
-    timestamp_utc = Column(String, primary_key=True, index=True)
+    timestamp_utc = Column(DateTime(timezone=True), primary_key=True, index=True)
     gpu_model = Column(String)
     gpu_usage_percent = Column(Float)
     gpu_power_watt = Column(Float)
@@ -25,10 +25,14 @@ class EnergyRaw(Base):
     risk_level = Column(String(10), nullable=True)  
     similarity_score = Column(Float, nullable=True)
 
+    __table_args__ = (
+        Index("ix_energy_raw_device_ts", "device_id", "timestamp_utc"),
+    )
+
 class EnergyCleaned(Base):
     __tablename__ = "energy_cleaned"
 
-    timestamp_utc = Column(String, primary_key=True, index=True)
+    timestamp_utc = Column(DateTime(timezone=True), primary_key=True, index=True)
     gpu_model = Column(String)
     gpu_usage_percent = Column(Float)
     gpu_power_watt = Column(Float)
@@ -0,0 +1,25 @@
+# app/routing.py
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+from typing import Any, Callable
+import orjson
+
+class ORJSONRequest(Request):
+    """以 orjson 解析 JSON request body"""
+
+    async def json(self) -> Any:
+        if not hasattr(self, "_json"):
+            self._json = orjson.loads(await self.body())
+        return self._json
+
+class ORJSONRoute(APIRoute):
+    """讓路由收到的 Request 改用 orjson 解析 body"""
+
+    def get_route_handler(self) -> Callable:
+        original_route_handler = super().get_route_handler()
+
+        async def orjson_route_handler(request: Request) -> Response:
+            request = ORJSONRequest(request.scope, request.receive)
+            return await original_route_handler(request)
+
+        return orjson_route_handler
@@ -1,10 +1,12 @@
 # app/schemas.py
-from pydantic import BaseModel, validator
+from pydantic import BaseModel, ConfigDict, field_validator
 from datetime import datetime
 from typing import Optional
 
 class EnergyData(BaseModel):
-    timestamp_utc: str
+    model_config = ConfigDict(frozen=True)
+
+    timestamp_utc: datetime
     gpu_model: str
     gpu_usage_percent: float
     gpu_power_watt: float
@@ -21,19 +23,22 @@ class EnergyData(BaseModel):
     location: str
     
     # 資料驗證
-    @validator('gpu_usage_percent')
+    @field_validator('gpu_usage_percent')
+    @classmethod
     def validate_gpu_usage(cls, v):
         if not 0 <= v <= 100:
             raise ValueError('GPU usage must be between 0 and 100')
         return v
     
-    @validator('gpu_power_watt', 'cpu_power_watt', 'system_power_watt')
+    @field_validator('gpu_power_watt', 'cpu_power_watt', 'system_power_watt')
+    @classmethod
     def validate_power(cls, v):
         if not 0 <= v <= 1000:
             raise ValueError('Power consumption must be between 0 and 1000W')
         return v
     
-    @validator('memory_used_mb')
+    @field_validator('memory_used_mb')
+    @classmethod
     def validate_memory(cls, v):
         if not 0 <= v <= 128000:
             raise ValueError('Memory usage must be between 0 and 128GB')
@@ -55,5 +60,4 @@ class DeviceResponse(BaseModel):
     is_active: bool
     notes: Optional[str]
     
-    class Config:
-        from_attributes = True
\ No newline at end of file
+    model_config = ConfigDict(from_attributes=True)
\ No newline at end of file